@@ -14,8 +14,8 @@
 
 import os
 import json
-import random
 import logging
+import subprocess
 
 from datetime import timedelta
 from typing import Any, Dict, List
@@ -36,6 +36,9 @@ log = logging.getLogger("PerfEngine")
 class BackendGPU(Backend):
     def __init__(self, workload_dict):
         super().__init__(workload_dict)
+        self._graph_primed = False
+        # numa node of each torch device index, resolved once
+        self._numa_node_cache = {}
 
     def get_torch_device_name(self):
         return "cuda"
@@ -57,6 +60,37 @@ class BackendGPU(Backend):
     
     def get_device(self):
         return torch.cuda.current_device()
+
+    def _get_pci_bus_id(self, index):
+        # torch ordinals follow CUDA_VISIBLE_DEVICES and CUDA_DEVICE_ORDER while nvidia-smi indices don't,
+        # so identify the device by its pci ids or uuid as seen from torch
+        props = torch.cuda.get_device_properties(index)
+        if hasattr(props, "pci_bus_id"):
+            return f"{props.pci_domain_id:04x}:{props.pci_bus_id:02x}:{props.pci_device_id:02x}.0"
+
+        uuid = str(props.uuid)
+        output = subprocess.check_output(
+            ["nvidia-smi", "--query-gpu=uuid,pci.bus_id", "--format=csv,noheader"]
+        ).decode()
+        for line in output.strip().splitlines():
+            smi_uuid, bus_id = [item.strip() for item in line.split(",")]
+            if smi_uuid.lower().removeprefix("gpu-") == uuid.lower().removeprefix("gpu-"):
+                # nvidia-smi: 00000000:17:00.0, sysfs: 0000:17:00.0
+                domain, bus = bus_id.split(":", 1)
+                return f"{int(domain, 16):04x}:{bus.lower()}"
+        raise RuntimeError(f"device uuid {uuid} not found in nvidia-smi output")
+
+    def get_gpu_numa_node(self, index = 0):
+        if index in self._numa_node_cache:
+            return self._numa_node_cache[index]
+        try:
+            with open(f"/sys/bus/pci/devices/{self._get_pci_bus_id(index)}/numa_node") as f:
+                numa_node = int(f.read().strip())
+        except Exception as e:
+            log.debug(f"get numa node of device {index} failed, error msg: {e}")
+            numa_node = -1
+        self._numa_node_cache[index] = numa_node
+        return numa_node
     
     def device_synchronize(self):
         torch.cuda.synchronize()
@@ -64,6 +98,45 @@ class BackendGPU(Backend):
     def empty_cache(self):
         torch.cuda.empty_cache()
 
+    def supports_cuda_graph(self):
+        return True
+
+    def _prime_graph(self, max_nodes=4096):
+        # pay one-shot graph capture / instantiation cost with a throwaway graph
+        dummy_tensor = torch.empty(1, device=self.get_torch_device_name())
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            for _ in range(max_nodes):
+                dummy_tensor.add_(0)
+        graph.replay()
+        self.device_synchronize()
+        del graph, dummy_tensor
+
+    def capture_graph(self, func):
+        # device is set after __init__, so prime lazily on first capture
+        if not self._graph_primed:
+            self._prime_graph()
+            self._graph_primed = True
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            func()
+        return graph
+
+    def create_stream(self):
+        return torch.cuda.Stream()
+
+    def stream_context(self, stream):
+        return torch.cuda.stream(stream)
+
+    def wait_stream(self, stream):
+        torch.cuda.current_stream().wait_stream(stream)
+
+    def create_event(self):
+        return torch.cuda.Event(enable_timing=True)
+
+    def record_event(self, event, stream=None):
+        event.record(stream)
+
 
     def get_dist_module(self):
         return dist
@@ -92,20 +165,3 @@ class BackendGPU(Backend):
             timeout=timedelta(seconds=1800)
         )
         return True
-
-    def core_perf(self, prefer_iterations, tensor_list):
-        start_event = torch.cuda.Event(enable_timing=True)
-        end_event = torch.cuda.Event(enable_timing=True)
-
-        self.device_synchronize()
-        self.barrier()
-
-        start_event.record()
-        for i in range(prefer_iterations):
-            self._run_operation(self.op, random.choice(tensor_list))
-        end_event.record()
-
-        self.device_synchronize()
-        self.barrier()
-        
-        return start_event.elapsed_time(end_event) * 1e3 / prefer_iterations
\ No newline at end of file
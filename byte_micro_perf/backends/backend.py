@@ -18,22 +18,83 @@ import json
 import math
 import random
 import logging
-import traceback
+import itertools
+import contextlib
 from abc import ABC
 from typing import Any, Dict, List
 
 import torch
 
 from backends import module_store
-from backends.utils import dump_communication_ops_report, dump_computation_ops_report
+from backends.utils import dump_communication_ops_report, dump_computation_ops_report, numa_preferred
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("PerfEngine")
 
+# compiled core_perf loop, opt-in with BYTE_MLPERF_PERF_DISPATCH=1 and requires cython,
+# fallback to python loop otherwise
+perf_dispatch = None
+if os.environ.get("BYTE_MLPERF_PERF_DISPATCH") == "1":
+    try:
+        import pyximport
+        importers = pyximport.install(language_level=3)
+        try:
+            from backends import perf_dispatch
+        finally:
+            # don't leave a process-wide .pyx import hook behind
+            pyximport.uninstall(*importers)
+    except Exception as e:
+        log.warning(f"build perf_dispatch failed, fallback to python loop, error msg: {e}")
+
+
+_COMM_OPS = frozenset([
+    "allreduce", "allgather", "reducescatter", "alltoall", "broadcast", "p2p", 
+    "device2host", "host2device"
+])
+# ops which only create one set of tensors
+_SINGLE_DATA_OPS = _COMM_OPS | {"hash_table"}
+# memory-bound ops measured with a narrower dtype if the requested one doesn't fit,
+# kernel bandwidth is their figure of merit
+_MEMORY_BOUND_OPS = frozenset([
+    "device2device", "add", "sub", "mul", "reduce_sum", "reduce_min", "reduce_max"
+])
+_NARROW_DTYPES = [torch.float16, torch.int8]
+# alignment of separate allocations from the caching allocator
+_SLOT_ALIGN_BYTES = 512
+
+_DTYPE_MAP = {
+    name: getattr(torch, name) for name in [
+        "float32", "float16", "bfloat16", "float64", "float8_e4m3fn", "float8_e5m2",
+        "int8", "uint8", "int16", "int32", "int64", "bool"
+    ] if hasattr(torch, name)
+}
+
+
+def _to_torch_dtype(dtype):
+    return _DTYPE_MAP[dtype] if dtype in _DTYPE_MAP else getattr(torch, dtype)
+
+
+def _freeze(obj):
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(item) for item in obj)
+    return obj
+
+
+class HostEvent:
+    """
+    host timer fallback with the same interface as torch.cuda.Event
+    """
+    def __init__(self):
+        self.timestamp_ns = None
+
+    def record(self, stream=None):
+        self.timestamp_ns = time.perf_counter_ns()
+
+    def synchronize(self):
+        pass
 
-default_op_registry = module_store.op_registry.copy()
-default_op_compute_size_registry = module_store.op_compute_size_funcs.copy()
-default_op_create_tensors_registry = module_store.op_create_tensors_funcs.copy()
+    def elapsed_time(self, end_event):
+        return (end_event.timestamp_ns - self.timestamp_ns) / 1e6
 
 
 class Backend(ABC):
@@ -45,6 +106,11 @@ class Backend(ABC):
         # communication params
         self.world_size = None
         self.rank = None
+        # dist module and group state, set once ccl is initialized
+        self._dist = None
+        self._dist_initialized = False
+        # only multi-rank groups need to sync
+        self._needs_barrier = False
 
         # hardware info
         self.device_name = self.get_device_name()
@@ -52,27 +118,36 @@ class Backend(ABC):
         self.avail_memory, self.total_memory = self.get_mem_info()
         self.memory_limit = self.avail_memory // (1024**3)
 
+        # avoid use cache, assume cache size is 1 GiB, and use 90% of available device memory
+        self._cache_size_bytes = 1 << 30
+        self._avail_budget_bytes = (self.memory_limit * 9 * 1024**3) // 10
+
+        # empty_cache after every perf(), opt-in by workload
+        self.force_empty_cache = workload_dict.get("empty_cache", False)
+        self._last_cleared = False
+
+        # compute_size_func results of each (input_shapes, dtype)
+        self._size_info_cache = {}
+
+        self._torch_device_name = self.get_torch_device_name()
+        self._bind_op()
+
 
     """
     op
     """
-    def get_op_instance(self):
-        if self.op_name in default_op_registry:
-            self.op = default_op_registry[self.op_name]
-        else:
-            raise NotImplementedError
-
-    def get_op_compute_size_func(self):
-        if self.op_name in default_op_compute_size_registry:
-            return default_op_compute_size_registry[self.op_name]
-        else:
-            raise NotImplementedError
-        
-    def get_op_create_tensors_func(self):
-        if self.op_name in default_op_create_tensors_registry:
-            return default_op_create_tensors_registry[self.op_name]
-        else:
-            raise NotImplementedError
+    def _bind_op(self):
+        # resolve op and its helper funcs once instead of on every perf(),
+        # look up the live registries so ops registered after import are visible
+        self.op = module_store.op_registry.get(self.op_name)
+        if self.op is None:
+            raise NotImplementedError(self.op_name)
+        self._compute_size_func = module_store.op_compute_size_funcs.get(self.op_name)
+        if self._compute_size_func is None:
+            raise NotImplementedError(self.op_name)
+        self._create_tensors_func = module_store.op_create_tensors_funcs.get(self.op_name)
+        if self._create_tensors_func is None:
+            raise NotImplementedError(self.op_name)
 
 
 
@@ -100,12 +175,56 @@ class Backend(ABC):
     def get_device(self) -> int:
         raise NotImplementedError
 
+    def get_gpu_numa_node(self, index = 0) -> int:
+        return -1
+
     def device_synchronize(self):
         raise NotImplementedError
 
     def empty_cache(self):
         raise NotImplementedError
 
+    # fix device clocks during measurement if the backend is able to, no-op by default
+    def lock_clocks(self):
+        pass
+
+    # graph capture, backends without it run ops eagerly in core_perf
+    def supports_cuda_graph(self):
+        return False
+
+    def capture_graph(self, func):
+        """
+        capture device work issued by func() into a replayable graph, None if unsupported
+        """
+        return None
+
+    def replay_graph(self, graph):
+        graph.replay()
+
+    # streams, backends without them run everything in order on the default queue
+    def create_stream(self):
+        return None
+
+    def stream_context(self, stream):
+        return contextlib.nullcontext()
+
+    def wait_stream(self, stream):
+        pass
+
+    # elapsed time between events is measured in milliseconds
+    def create_event(self):
+        return HostEvent()
+
+    def record_event(self, event, stream=None):
+        self.device_synchronize()
+        event.record(stream)
+
+    def event_synchronize(self, event):
+        event.synchronize()
+
+    def event_elapsed(self, start_event, end_event):
+        return start_event.elapsed_time(end_event)
+
 
     """
     ccl related
@@ -115,16 +234,33 @@ class Backend(ABC):
 
     def initialize_ccl(self, rank, world_size):
         raise NotImplementedError
+
+    def on_ccl_initialized(self):
+        # record dist state once the process group is up, called by engine after initialize_ccl
+        dist = self.get_dist_module()
+        if not dist.is_initialized():
+            return
+        self._dist = dist
+        self._dist_initialized = True
+        self._needs_barrier = dist.get_world_size() > 1
     
     def destroy_process_group(self):
-        dist = self.get_dist_module()
-        if dist.is_initialized():
-            dist.destroy_process_group()
+        if self._dist_initialized:
+            self._dist.destroy_process_group()
+            self._dist_initialized = False
+            self._needs_barrier = False
+
+    def _all_reduce_max(self, value):
+        # keep data-dependent decisions identical on all ranks of a group
+        if not (self._dist_initialized and self._needs_barrier):
+            return value
+        tensor = torch.tensor([value], dtype=torch.float64, device=self._torch_device_name)
+        self._dist.all_reduce(tensor, op=self._dist.ReduceOp.MAX)
+        return tensor.item()
 
     def barrier(self):
-        dist = self.get_dist_module()
-        if dist.is_initialized():
-            dist.barrier()
+        if self._dist_initialized and self._needs_barrier:
+            self._dist.barrier()
 
 
     def _run_operation(self, operation, inputs):
@@ -132,10 +268,73 @@ class Backend(ABC):
         return result
 
 
-    def build_tensor(self, input_shapes, torch_dtype):
-        # get funcs
-        compute_size_func = self.get_op_compute_size_func()
-        result = compute_size_func(input_shapes, torch_dtype)
+    def _build_cuda_graph(self, tensor_list):
+        def run_tensor_list():
+            for inputs in tensor_list:
+                self._run_operation(self.op, inputs)
+
+        # warm up on a side stream before capture, as required by graph capture
+        stream = self.create_stream()
+        self.device_synchronize()
+        with self.stream_context(stream):
+            run_tensor_list()
+        self.wait_stream(stream)
+
+        # capture one pass over tensor_list, ops with host sync can not be captured
+        try:
+            graph = self.capture_graph(run_tensor_list)
+        except Exception as e:
+            log.debug(f"capture cuda graph for {self.op_name} failed, fallback to eager mode, error msg: {e}")
+            self.device_synchronize()
+            return None
+        if graph is None:
+            return None
+
+        # first launch uploads the graph to device, keep it out of core_perf
+        self.replay_graph(graph)
+        self.device_synchronize()
+        return graph
+
+    def _reserve_device_memory(self, required_bytes):
+        # keep cached blocks for reuse, only return them to device if required_bytes may not fit
+        if not self._last_cleared and self.get_mem_info()[0] < 2 * required_bytes:
+            self.empty_cache()
+            self._last_cleared = True
+
+
+    def _create_batched_tensor_list(self, input_shapes, torch_dtype, max_data_cnt):
+        # create one set of tensors to get shapes, dtypes and valid values of each input
+        prototype = self._create_tensors_func(input_shapes, torch_dtype, self._torch_device_name)
+        if not all(isinstance(tensor, torch.Tensor) and tensor.is_contiguous() for tensor in prototype):
+            return None
+
+        # allocate each input once for all iterations, hand out views of it,
+        # pad each slot to _SLOT_ALIGN_BYTES so views are aligned like separate allocations
+        batched_tensors = []
+        for tensor in prototype:
+            slot_bytes = (tensor.numel() * tensor.element_size() + _SLOT_ALIGN_BYTES - 1) // _SLOT_ALIGN_BYTES * _SLOT_ALIGN_BYTES
+            slot_numel = slot_bytes // tensor.element_size()
+            batched_tensor = torch.empty((max_data_cnt, slot_numel), dtype=tensor.dtype, device=tensor.device)
+            batched_tensor = batched_tensor[:, :tensor.numel()]
+            batched_tensor.copy_(tensor.reshape(1, -1))
+            batched_tensors.append((batched_tensor, tensor.shape))
+        return tuple(
+            tuple(batched_tensor[i].view(shape) for batched_tensor, shape in batched_tensors) for i in range(max_data_cnt)
+        )
+
+
+    def _get_size_info(self, input_shapes, torch_dtype):
+        key = (_freeze(input_shapes), torch_dtype)
+        size_info = self._size_info_cache.get(key)
+        if size_info is None:
+            size_info = self._compute_size_func(input_shapes, torch_dtype)
+            self._size_info_cache[key] = size_info
+        return size_info
+
+
+    def build_tensor(self, input_shapes, torch_dtype, batched=True, size_info=None):
+        # get tensor size
+        result = size_info if size_info is not None else self._get_size_info(input_shapes, torch_dtype)
 
         # 4: (bs, rw_bytes, r_bytes, w_bytes)  assume tensor_size = rw_bytes
         # 5: (bs, rw_bytes, r_bytes, w_bytes, tensor_size)
@@ -143,112 +342,201 @@ class Backend(ABC):
             tensor_size = result[1]
         elif len(result) == 5:
             tensor_size = result[4]
-            
-        create_tensors_func = self.get_op_create_tensors_func()
-        
-        # avoid use cache, assume cache size is 1 GiB, and use 80% of available device memory
-        assume_cache_size = 1 * 1024**3
 
-        assume_avail_bytes = self.memory_limit * 0.9 * 1024**3
+        assume_cache_size = self._cache_size_bytes
+        assume_avail_bytes = self._avail_budget_bytes
 
+        # 0: OOM, 1: only fits once, 2: larger than cache, otherwise as many as fit
+        fits_once = tensor_size <= assume_avail_bytes
+        fits_twice = 2 * tensor_size <= assume_avail_bytes
+        fits_cache = tensor_size <= assume_cache_size
+        max_data_cnt = (
+            (assume_avail_bytes // tensor_size if fits_cache else 2) if fits_twice else 1
+        ) if fits_once else 0
+        max_data_cnt = min(max_data_cnt, 1 if self.op_name in _SINGLE_DATA_OPS else self.iterations)
+        if max_data_cnt == 0:
+            return ()
 
+        self._reserve_device_memory(max_data_cnt * tensor_size)
 
-        if self.op_name in ["allreduce", "allgather", "reducescatter", "alltoall", "broadcast", "p2p", "device2host", "host2device", "hash_table"]:
-            if tensor_size > assume_avail_bytes:
-                return []
-            else:
-                max_data_cnt = 1
-        else:
-            if tensor_size > assume_avail_bytes:
-                return [], 0, tensor_size
-            elif 2 * tensor_size > assume_avail_bytes:
-                max_data_cnt = 1
-            elif tensor_size > assume_cache_size:
-                max_data_cnt = 2
-            else:
-                max_data_cnt = min(math.floor(assume_avail_bytes / tensor_size), self.iterations)
+        # place host buffers of h2d/d2h copies on the numa node local to current device
+        numa_node = -1
+        if self.op_name in ["device2host", "host2device"]:
+            numa_node = self.get_gpu_numa_node(self.get_device())
 
         # create tensor_list for each op
-        tensor_list = [
-            create_tensors_func(input_shapes, torch_dtype, self.get_torch_device_name()) for _ in range(max_data_cnt)
-        ]
+        with numa_preferred(numa_node):
+            # batched creation keeps one extra prototype alive while copying
+            tensor_list = None
+            if (
+                batched and max_data_cnt > 1
+                and getattr(self._create_tensors_func, "batchable", True)
+                and (max_data_cnt + 1) * tensor_size <= assume_avail_bytes
+            ):
+                tensor_list = self._create_batched_tensor_list(input_shapes, torch_dtype, max_data_cnt)
+            if tensor_list is None:
+                tensor_list = tuple(
+                    self._create_tensors_func(input_shapes, torch_dtype, self._torch_device_name) for _ in range(max_data_cnt)
+                )
+        self._last_cleared = False
         return tensor_list
 
 
-    def core_perf(self, prefer_iterations, tensor_list):
+    def _build_narrow_tensor(self, input_shapes, torch_dtype):
+        # try narrower dtypes with the same shapes, return (measure_dtype, size_info, tensor_list)
+        dtype_size = torch.tensor([], dtype=torch_dtype).element_size()
+        for narrow_dtype in _NARROW_DTYPES:
+            if torch.tensor([], dtype=narrow_dtype).element_size() >= dtype_size:
+                continue
+            size_info = self._get_size_info(input_shapes, narrow_dtype)
+            tensor_list = self.build_tensor(input_shapes, narrow_dtype, size_info=size_info)
+            if len(tensor_list) > 0:
+                return narrow_dtype, size_info, tensor_list
+        return torch_dtype, None, ()
+
+
+    def _warmup(self, tensor_list, warm_schedule):
         self.device_synchronize()
         self.barrier()
-        start_time = time.perf_counter_ns()
-        for i in range(prefer_iterations):
-            self._run_operation(self.op, tensor_list[i % len(tensor_list)])
+        for idx in warm_schedule:
+            self._run_operation(self.op, tensor_list[idx])
+
+        # capture computation ops into cuda graph to remove launch overhead,
+        # graphs are not kept across perf() calls as their private memory pool isn't budgeted
+        cuda_graph = None
+        if self.op_name not in _COMM_OPS and self.supports_cuda_graph():
+            cuda_graph = self._build_cuda_graph(tensor_list)
+        self.device_synchronize()
+        return cuda_graph
+
+
+    def _probe(self, tensor_list, test_schedule, cuda_graph=None):
+        probe_budget = 0.2
+        min_total_duration = 0.1
+        max_total_duration = 10.
+        min_iterations = max(100, self.iterations)
+
+        # time the same launch path as core_perf, one graph replay runs len(tensor_list) ops
+        ops_per_step = len(tensor_list) if cuda_graph is not None else 1
+        max_steps = max(1, len(test_schedule) // ops_per_step)
+
+        # double test_steps until probe_budget is spent or test_schedule is used up
+        test_steps = min(2, max_steps)
+        while True:
+            start_event = self.create_event()
+            end_event = self.create_event()
+            self.device_synchronize()
+            self.barrier()
+            self.record_event(start_event)
+            if cuda_graph is not None:
+                for _ in range(test_steps):
+                    self.replay_graph(cuda_graph)
+            else:
+                for idx in test_schedule[:test_steps]:
+                    self._run_operation(self.op, tensor_list[idx])
+            self.record_event(end_event)
+            self.event_synchronize(end_event)
+            self.barrier()
+            probe_duration = self._all_reduce_max(self.event_elapsed(start_event, end_event) / 1e3)
+            if probe_duration > probe_budget or test_steps >= max_steps:
+                break
+            test_steps = min(test_steps * 2, max_steps)
+        avg_op_duration = max(probe_duration / (test_steps * ops_per_step), 1e-9)
+
+        # run at least min_total_duration to get past clock ramp-up, at most max_total_duration
+        prefer_iterations = max(min_iterations, math.ceil(min_total_duration / avg_op_duration))
+        return max(2, min(prefer_iterations, math.ceil(max_total_duration / avg_op_duration)))
+
+
+    def core_perf(self, prefer_iterations, tensor_list, cuda_graph=None):
+        start_event = self.create_event()
+        end_event = self.create_event()
+
         self.device_synchronize()
         self.barrier()
-        end_time = time.perf_counter_ns()
 
-        return (end_time - start_time) / 1e3 / prefer_iterations
+        self.record_event(start_event)
+        if cuda_graph is not None:
+            replay_iterations = max(1, prefer_iterations // len(tensor_list))
+            for _ in range(replay_iterations):
+                self.replay_graph(cuda_graph)
+            prefer_iterations = replay_iterations * len(tensor_list)
+        else:
+            # bind locals and call op directly to keep interpreter overhead out of the measurement
+            op = self.op
+            if perf_dispatch is not None:
+                perf_dispatch.run_n(op, tensor_list, prefer_iterations)
+            else:
+                for inputs in itertools.islice(itertools.cycle(tensor_list), prefer_iterations):
+                    op(*inputs)
+        self.record_event(end_event)
+
+        self.event_synchronize(end_event)
+        self.barrier()
+
+        return self.event_elapsed(start_event, end_event) * 1e3 / prefer_iterations
 
 
     def perf(self, input_shapes: List[List[int]], dtype):
         error = ""
 
         # create necessary tensors
-        torch_dtype = getattr(torch, dtype)
-        tensor_list = self.build_tensor(input_shapes, torch_dtype)
+        torch_dtype = _to_torch_dtype(dtype)
+        size_info = self._get_size_info(input_shapes, torch_dtype)
+        tensor_list = self.build_tensor(input_shapes, torch_dtype, size_info=size_info)
 
+        # requested dtype doesn't fit, measure memory-bound ops with a narrower dtype
+        measure_dtype, measure_size_info = torch_dtype, size_info
+        if len(tensor_list) == 0 and self.op_name in _MEMORY_BOUND_OPS:
+            measure_dtype, measure_size_info, tensor_list = self._build_narrow_tensor(input_shapes, torch_dtype)
 
-        if len(tensor_list) > 0:
+        latency = 0
+        if len(tensor_list) == 0:
+            error = "OOM"
+        else:
+            # sample input schedule up front, keep rng out of the timed loops
+            warm_iterations = 5
+            max_test_iterations = 32
+            schedule = [i % len(tensor_list) for i in range(max(warm_iterations, max_test_iterations))]
+            random.shuffle(schedule)
+
+            # each phase synchronizes before returning, so async errors are reported by the phase raising them
             try:
-                warm_iterations = 5
-                test_iterations = 5
-                max_total_duration = 10.
-                prefer_iterations = self.iterations
-
-                # warmup
-                self.device_synchronize()
-                self.barrier()
-                for _ in range(warm_iterations):
-                    self._run_operation(self.op, random.choice(tensor_list))
-
-                # test perf
-                self.device_synchronize()
-                self.barrier()
-                start_time = time.perf_counter_ns()
-                for i in range(test_iterations):
-                    self._run_operation(self.op, random.choice(tensor_list))
-                self.device_synchronize()
-                self.barrier()
-                end_time = time.perf_counter_ns()
-                avg_op_duration = (end_time - start_time) / 1e9 / test_iterations
-
-
-                if avg_op_duration > max_total_duration:
-                    prefer_iterations = 2
-                else:
-                    prefer_iterations = min(math.ceil(max_total_duration / avg_op_duration), self.iterations)
-
-                latency = round(self.core_perf(prefer_iterations, tensor_list), 2)
-
-            except Exception as e:
-                traceback.print_exc()
-                latency = 0
+                cuda_graph = self._warmup(tensor_list, schedule[:warm_iterations])
+            except Exception:
+                log.exception(f"warmup op: {self.op_name} failed, input_shape: {input_shapes}, dtype: {dtype}")
                 error = "RUN_OP_ERROR"
-        else:
-            latency = 0
-            error = "OOM"
-        
-        # clean tensors and device memory
+
+            if not error:
+                try:
+                    prefer_iterations = self._probe(tensor_list, schedule[:max_test_iterations], cuda_graph)
+                except Exception:
+                    log.exception(f"probe op: {self.op_name} failed, input_shape: {input_shapes}, dtype: {dtype}")
+                    error = "RUN_OP_ERROR"
+
+            if not error:
+                try:
+                    latency = self.core_perf(prefer_iterations, tensor_list, cuda_graph)
+                    # scale to the latency of moving the requested dtype's bytes at measured bandwidth
+                    latency = round(latency * size_info[1] / measure_size_info[1], 2)
+                except Exception:
+                    log.exception(f"measure op: {self.op_name} failed, input_shape: {input_shapes}, dtype: {dtype}")
+                    error = "RUN_OP_ERROR"
+
+        # configs are not measured twice, so release the graph and tensors to the caching allocator,
+        # device memory is only returned when needed or if tensors of a failed run may be broken
+        cuda_graph = None
         del tensor_list
-        self.empty_cache()
+        if self.force_empty_cache or error == "RUN_OP_ERROR":
+            self.empty_cache()
+            self._last_cleared = True
 
 
         # create report for communication ops and computation ops
-        if self.op_name in [
-            "allreduce", "allgather", "reducescatter", "alltoall", "broadcast", "p2p", 
-            "device2host", "host2device"
-        ]:
+        if self.op_name in _COMM_OPS:
             report = dump_communication_ops_report(
                 self.op_name, torch_dtype, input_shapes, 
-                self.get_op_compute_size_func(), 
+                size_info, 
                 self.world_size, 
                 None,
                 latency,
@@ -257,10 +545,11 @@ class Backend(ABC):
         else:
             report = dump_computation_ops_report(
                 self.op_name, torch_dtype, input_shapes, 
-                self.get_op_compute_size_func(), 
+                size_info, 
                 None, 
                 latency, 
                 error
             )
+        if measure_dtype != torch_dtype:
+            report["Measured Dtype"] = str(measure_dtype).split(".")[-1]
         return report
-
@@ -159,6 +159,9 @@ def group_gemm_create_tensors(input_shapes, torch_dtype, xpu_device):
 
     return [left_tensors, right_tensors, output_tensors]
 
+# nested tensor lists, can not be created as batched tensors
+group_gemm_create_tensors.batchable = False
+
 
 
 def sin_compute_size(input_shapes, torch_dtype):
@@ -566,6 +569,9 @@ def scatter_create_tensors(input_shapes, torch_dtype, xpu_device):
 
     return [dst_tensor, src_tensor, index_tensor]
 
+# index_tensor is an expanded view, batching would materialize it
+scatter_create_tensors.batchable = False
+
 
 def hash_table_compute_size(input_shapes, torch_dtype):
     a_shape, b_shape = input_shapes
@@ -725,6 +731,9 @@ def host2device_create_tensors(input_shapes, torch_dtype, xpu_device):
     )
     return [host_tensor, device_tensor]
 
+# host_tensor needs pinned memory
+host2device_create_tensors.batchable = False
+
 def device2device_create_tensors(input_shapes, torch_dtype, xpu_device):
     a_shape, = input_shapes
     batch_size, hidden_size = a_shape
@@ -0,0 +1,24 @@
+# Copyright 2023 ByteDance and/or its affiliates.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+
+def run_n(op, schedule, Py_ssize_t n):
+    """
+    call op(*schedule[i % len(schedule)]) for i in range(n) with a C loop
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t data_cnt = len(schedule)
+    for i in range(n):
+        op(*schedule[i % data_cnt])
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import math
+import ctypes
+import contextlib
 from typing import List
 
 import numpy as np
@@ -21,11 +23,55 @@ import torch
 from backends import module_store
 
 
+_libnuma = None
+
+
+def _get_libnuma():
+    global _libnuma
+    if _libnuma is None:
+        try:
+            libnuma = ctypes.CDLL("libnuma.so.1")
+            _libnuma = libnuma if libnuma.numa_available() >= 0 else False
+        except OSError:
+            _libnuma = False
+    return _libnuma
+
+
+def _get_mempolicy(libnuma):
+    # current (mode, nodemask) of this thread, None if it can't be read
+    maxnode = libnuma.numa_num_possible_nodes()
+    nodemask = (ctypes.c_ulong * ((maxnode + 63) // 64))()
+    mode = ctypes.c_int()
+    if libnuma.get_mempolicy(ctypes.byref(mode), nodemask, ctypes.c_ulong(len(nodemask) * 64), None, 0) != 0:
+        return None
+    return mode.value, nodemask
+
+
+@contextlib.contextmanager
+def numa_preferred(numa_node: int):
+    """
+    prefer allocating pages on numa_node for host memory touched in this thread,
+    e.g. pinned buffers of h2d/d2h copies. no-op if libnuma is missing or numa_node < 0.
+    """
+    libnuma = _get_libnuma() if numa_node >= 0 else False
+    saved_policy = _get_mempolicy(libnuma) if libnuma else None
+    if saved_policy is None:
+        yield
+        return
+    libnuma.numa_set_preferred(numa_node)
+    try:
+        yield
+    finally:
+        # restore policy of this thread, e.g. one set by numactl --membind/--preferred
+        mode, nodemask = saved_policy
+        libnuma.set_mempolicy(mode, nodemask, ctypes.c_ulong(len(nodemask) * 64))
+
+
 def dump_communication_ops_report(
     op_name: str,
     torch_dtype,
     input_shapes: List[List[int]],
-    compute_size_func, 
+    size_info, 
     group_size: int,
     bandwidth_limit: float,
     latency: float,
@@ -34,7 +80,7 @@ def dump_communication_ops_report(
     # get dtype name and dtype_size
     dtype_name = str(torch_dtype).split(".")[-1]
     
-    # ignore compute_size_func
+    # ignore size_info
     dtype_size = torch.tensor([], dtype=torch_dtype).element_size()
     element_num = math.prod(input_shapes[0])
     tensor_size = dtype_size * element_num
@@ -90,19 +136,17 @@ def dump_computation_ops_report(
     op_name: str,
     torch_dtype: str,
     input_shapes: List[List[int]], 
-    compute_size_func, 
+    size_info, 
     bandwidth_limit: float,
     latency: float,
     error: str = ""
 ):
     # get dtype name and dtype_size
     dtype_name = str(torch_dtype).split(".")[-1]
-    result = compute_size_func(input_shapes, torch_dtype)
-    
-    batch_size = result[0]
-    tensor_size = result[1]
-    input_tensor_size = result[2]
-    output_tensor_size = result[3]
+    batch_size = size_info[0]
+    tensor_size = size_info[1]
+    input_tensor_size = size_info[2]
+    output_tensor_size = size_info[3]
     
     if error == "":
         qps = round(1e6 / latency * batch_size, 2)
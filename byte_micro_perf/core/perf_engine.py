@@ -422,12 +422,13 @@ class PerfEngine:
         backend_instance.world_size = world_size
 
         backend_instance.set_device(rank)
+        backend_instance.lock_clocks()
 
         if group_size > 1:
             backend_instance.initialize_ccl(rank, world_size)
+            backend_instance.on_ccl_initialized()
 
         op_name = self.workload["operator"]
-        backend_instance.get_op_instance()
 
         output_queues.put("ready")
 